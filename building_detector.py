@@ -3,16 +3,100 @@ import numpy as np
 import os
 import pandas as pd
 import random
+import re
+import shutil
+import sys
+import argparse
+import hashlib
 from pathlib import Path
 import matplotlib.pyplot as plt
+from memory_scheduler import MemoryBudgetScheduler
+from output_writer import OutputWriter, numbered_image_stem
+from input_discovery import discover_images, output_stem, relative_image_name, shares_stem
+from change_detection import compare_runs
 
-def detect_buildings_in_folder(input_folder_path, output_folder="output"):
+RESULTS_CSV_NAME = "building_detection_results.csv"
+RESULTS_CSV_COLUMNS = ['image_filename', 'building_count', 'total_building_area_pixels',
+                       'building_centers_area_pixels', 'coverage_percentage', 'output_image',
+                       'individual_csv', 'image_width', 'image_height', 'input_type']
+BUILDING_CSV_COLUMNS = ['building_number', 'center_x', 'center_y', 'area_pixels', 'label_id']
+# Number of pixels sampled when detecting whether an image is a binary mask
+INPUT_TYPE_SAMPLE_PIXELS = 65536
+# Intermediate rasters of process_single_image that can be saved as .npy
+INTERMEDIATE_ARRAYS = ('binary', 'dist_transform', 'peak_labels')
+SHARD_CSV_PATTERN = re.compile(r"^building_detection_results_shard_(\d+)_of_(\d+)\.csv$")
+
+def parse_shard(shard_spec):
+    """
+    Parse a shard specification of the form "i/N" (0 <= i < N).
+    
+    Parameters:
+    - shard_spec: Shard string, e.g. "0/4"
+    
+    Returns:
+    - Tuple (shard_index, shard_count)
+    """
+    
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", str(shard_spec))
+    if not match:
+        raise ValueError(f"Invalid shard '{shard_spec}', expected the form i/N (e.g. 0/4)")
+    
+    shard_index, shard_count = int(match.group(1)), int(match.group(2))
+    if shard_count < 1 or shard_index >= shard_count:
+        raise ValueError(f"Invalid shard '{shard_spec}', index must satisfy 0 <= i < N")
+    
+    return shard_index, shard_count
+
+def shard_of(image_name, shard_count):
+    """
+    Return the shard index an image belongs to.
+    
+    Uses a BLAKE2 hash of the image name (its path relative to the input
+    folder) so every machine assigns the same
+    images to the same shard, independent of directory order or Python's hash
+    seed. (CRC32 is linear, so similar names would pile up in few shards.)
+    """
+    
+    digest = hashlib.blake2b(str(image_name).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shard_count
+
+def shard_results_csv_name(shard_index, shard_count):
+    """Name of the summary CSV written by one shard of a batch run."""
+    
+    return f"building_detection_results_shard_{shard_index}_of_{shard_count}.csv"
+
+def detect_buildings_in_folder(input_folder_path, output_folder="output", shard=None,
+                               workers=1, memory_budget_mb=None, opencv_threads=None,
+                               writer=None, recursive=False, include=None, exclude=None,
+                               manifest=None, sort=False, save_intermediates=None,
+                               input_type='auto', mask_polarity='white'):
     """
     Detect buildings in all images within a folder using distance transform method.
     
     Parameters:
     - input_folder_path: Path to folder containing images
     - output_folder: Name of output folder to create
+    - shard: Optional (shard_index, shard_count) tuple; only images whose
+      name hashes to shard_index are processed and the summary is written
+      to a shard-specific CSV (see merge_shard_results)
+    - workers: Maximum number of images processed concurrently
+    - memory_budget_mb: Optional RAM budget; images are only started while the
+      estimated peak memory of all running images fits (see memory_scheduler)
+    - opencv_threads: OpenCV thread count while processing (default: cores / workers
+      when workers > 1, otherwise OpenCV's own setting)
+    - writer: Optional OutputWriter controlling the visualization codec, quality
+      and previews; by default PNGs and CSVs are written on two background threads
+    - recursive: Also process images in subfolders
+    - include, exclude: Optional lists of glob patterns selecting images
+    - manifest: Optional file listing image paths (one per line) to process
+      instead of scanning the folder; relative entries are resolved against
+      input_folder_path
+    - sort: Process images in sorted order; otherwise images are processed
+      in directory/manifest order as soon as they are found
+    - save_intermediates: Optional names from INTERMEDIATE_ARRAYS to save as
+      .npy files under images/intermediates (see load_intermediates)
+    - input_type: 'auto', 'image' or 'mask' (see process_single_image)
+    - mask_polarity: 'white' or 'black', the value buildings have in masks
     
     Returns:
     - DataFrame with results
@@ -24,43 +108,99 @@ def detect_buildings_in_folder(input_folder_path, output_folder="output"):
     images_output_path = output_path / "images"
     images_output_path.mkdir(exist_ok=True)
     
-    # Initialize results list
-    results = []
+    # Stream image files from the input folder (or manifest) so processing
+    # starts before enumeration has finished
+    image_files = discover_images(input_folder_path, recursive, include, exclude, manifest, sort)
+    
+    # Name every image by its path relative to the input folder, so images with
+    # the same file name in different subfolders get separate outputs
+    image_names = {}
+    
+    def name_images(image_files):
+        for image_file in image_files:
+            image_names[image_file] = relative_image_name(image_file, input_folder_path)
+            yield image_file
+    
+    image_files = name_images(image_files)
+    
+    if shard is not None:
+        shard_index, shard_count = shard
+        print(f"Processing shard {shard_index}/{shard_count}")
+        image_files = (f for f in image_files if shard_of(image_names[f], shard_count) == shard_index)
+    
+    # Remember the discovery order so results can be reported in it
+    discovery_order = {}
+    
+    def record_order(image_files):
+        for image_file in image_files:
+            discovery_order[image_file] = len(discovery_order)
+            yield image_file
+    
+    # Image and CSV writes run in the background; they are flushed before returning
+    owns_writer = writer is None
+    if owns_writer:
+        writer = OutputWriter()
     
-    # Supported image extensions
-    image_extensions = {'.tif', '.tiff', '.jpg', '.jpeg', '.png', '.bmp'}
+    def process(image_file):
+        print(f"\nProcessing: {image_names[image_file]}")
+        return process_single_image(image_file, images_output_path, writer=writer,
+                                    image_name=image_names[image_file],
+                                    save_intermediates=save_intermediates,
+                                    input_type=input_type, mask_polarity=mask_polarity)
     
-    # Get all image files in the input folder
-    input_path = Path(input_folder_path)
-    image_files = [f for f in input_path.iterdir() 
-                   if f.is_file() and f.suffix.lower() in image_extensions]
+    # Run images concurrently while their estimated memory fits the budget
+    memory_budget_bytes = int(memory_budget_mb * 1024 * 1024) if memory_budget_mb is not None else None
+    scheduler = MemoryBudgetScheduler(workers, memory_budget_bytes, opencv_threads)
     
-    if not image_files:
+    results_by_file = {}
+    for image_file, result, error in scheduler.run(process, record_order(image_files), writer):
+        if error is not None:
+            print(f"✗ Error processing {image_names[image_file]}: {str(error)}")
+        elif result:
+            results_by_file[image_file] = result
+            print(f"✓ Completed {image_names[image_file]}: {result['building_count']} buildings detected")
+        else:
+            print(f"✗ Failed to process: {image_names[image_file]}")
+    
+    # Make sure every image and CSV is on disk before reporting results
+    failed_writes = writer.close() if owns_writer else writer.flush()
+    if failed_writes:
+        print(f"✗ {len(failed_writes)} output file(s) could not be written")
+        
+        # An image whose outputs are incomplete counts as failed, so the
+        # results never list files that don't exist
+        failed_paths = {Path(path) for path, _ in failed_writes}
+        for image_file, result in list(results_by_file.items()):
+            outputs = {images_output_path / result[column]
+                       for column in ('output_image', 'individual_csv') if result[column]}
+            image_stem = numbered_image_stem(result['output_image'])
+            outputs.update(images_output_path / "intermediates" / f"{image_stem}_{name}.npy"
+                           for name in save_intermediates or ())
+            if outputs & failed_paths:
+                del results_by_file[image_file]
+                print(f"✗ Failed to write outputs of: {image_names[image_file]}")
+    
+    if not results_by_file and shard is not None:
+        # Record that this shard finished so merge doesn't report it missing
+        pd.DataFrame(columns=RESULTS_CSV_COLUMNS).to_csv(
+            output_path / shard_results_csv_name(*shard), index=False)
+    
+    if not discovery_order:
         print(f"No image files found in {input_folder_path}")
         return pd.DataFrame()
     
-    print(f"Found {len(image_files)} image files to process...")
+    print(f"\nFound {len(discovery_order)} image files")
     
-    for image_file in image_files:
-        print(f"\nProcessing: {image_file.name}")
-        
-        try:
-            # Process single image
-            result = process_single_image(image_file, images_output_path)
-            if result:
-                results.append(result)
-                print(f"✓ Completed: {result['building_count']} buildings detected")
-            else:
-                print(f"✗ Failed to process: {image_file.name}")
-                
-        except Exception as e:
-            print(f"✗ Error processing {image_file.name}: {str(e)}")
-            continue
+    # Keep the results in discovery order regardless of completion order
+    results = [results_by_file[f] for f in sorted(results_by_file, key=discovery_order.get)]
     
     # Create CSV with results
     if results:
         df = pd.DataFrame(results)
-        csv_path = output_path / "building_detection_results.csv"
+        if shard is not None:
+            csv_path = output_path / shard_results_csv_name(*shard)
+        else:
+            csv_path = output_path / RESULTS_CSV_NAME
         df.to_csv(csv_path, index=False)
         print(f"\n✓ Results saved to: {csv_path}")
         print(f"✓ Processed images saved to: {images_output_path}")
@@ -79,143 +219,440 @@ def detect_buildings_in_folder(input_folder_path, output_folder="output"):
         print("No images were successfully processed.")
         return pd.DataFrame()
 
-def process_single_image(image_path, output_dir):
+def detect_input_type(gray, sample_pixels=INPUT_TYPE_SAMPLE_PIXELS):
+    """
+    Detect whether a grayscale image is a binary mask or a regular image.
+    
+    Only a regular grid of about sample_pixels pixels is inspected, so this is
+    cheap even for very large rasters.
+    
+    Parameters:
+    - gray: Single-channel image
+    - sample_pixels: Approximate number of pixels to sample
+    
+    Returns:
+    - 'mask' if the sampled pixels take at most two values, otherwise 'image'
+    """
+    
+    step = max(1, int(np.sqrt(gray.size / sample_pixels)))
+    sample_values = np.unique(gray[::step, ::step])
+    return 'mask' if len(sample_values) <= 2 else 'image'
+
+def mask_to_binary(gray, mask_polarity='white'):
+    """
+    Threshold a binary mask directly into a 0/255 building mask.
+    
+    Parameters:
+    - gray: Single-channel mask (e.g. 0/255 or 0/1 labels)
+    - mask_polarity: 'white' if buildings are the brighter value (the usual
+      label mask convention), 'black' if buildings are the darker value
+    
+    Returns:
+    - uint8 array with buildings as 255
+    """
+    
+    low, high, _, _ = cv2.minMaxLoc(gray)
+    threshold = (low + high) / 2 if high > low else 0
+    if mask_polarity == 'white':
+        return cv2.compare(gray, threshold, cv2.CMP_GT)
+    return cv2.compare(gray, threshold, cv2.CMP_LE)
+
+def process_single_image(image_path, output_dir, writer=None, save_intermediates=None,
+                         input_type='auto', mask_polarity='white', image_name=None):
     """
     Process a single image to detect buildings using distance transform method.
     
     Parameters:
     - image_path: Path to the image file
     - output_dir: Directory to save the processed image
+    - writer: Optional OutputWriter; writes are queued on it and the caller must
+      flush it. Without one, a PNG and CSV are written before returning
+    - save_intermediates: Optional names from INTERMEDIATE_ARRAYS to save as
+      output_dir/intermediates/<image>_<name>.npy (see load_intermediates)
+    - input_type: 'image' for photos/scans (adaptive thresholding), 'mask' for
+      binary building masks (thresholded directly), or 'auto' to detect it
+    - mask_polarity: 'white' or 'black', the value buildings have in a mask
+    - image_name: Name reported in the results and used to name outputs,
+      e.g. the path relative to the input folder (default: the file name).
+      Outputs keep the image's extension in their names if another image
+      next to it has the same stem (e.g. a.tif and a.png)
     
     Returns:
     - Dictionary with detection results
     """
     
     try:
+        image_path = Path(image_path)
+        
         # Load image
         image = cv2.imread(str(image_path), cv2.IMREAD_UNCHANGED)
         if image is None:
             print(f"Could not load image: {image_path}")
             return None
         
-        # Convert to grayscale if needed
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image
+        image_name = image_name or image_path.name
+        image_stem = output_stem(image_name, keep_extension=shares_stem(image_path))
+        summary, _, _ = detect_buildings_in_image(image, image_name, output_dir, writer,
+                                                  save_intermediates, input_type, mask_polarity,
+                                                  image_stem)
+        return summary
         
+    except Exception as e:
+        print(f"Error processing {image_path}: {str(e)}")
+        return None
+
+def detect_buildings_in_bytes(image_bytes, image_name="image", output_dir=None, writer=None,
+                              save_intermediates=None, input_type='auto', mask_polarity='white'):
+    """
+    Detect buildings in an encoded image (PNG, JPEG, TIFF, ...) held in memory.
+    
+    Parameters:
+    - image_bytes: Encoded image as bytes, bytearray or memoryview
+    - image_name, output_dir, ...: As for detect_buildings_in_image
+    
+    Returns:
+    - Tuple (summary, buildings_df, numbered_viz) as for detect_buildings_in_image,
+      or None if the bytes could not be decoded
+    """
+    
+    buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+    if buffer.size == 0:
+        print(f"Could not decode image: {image_name} is empty")
+        return None
+    
+    image = cv2.imdecode(buffer, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        print(f"Could not decode image: {image_name}")
+        return None
+    
+    return detect_buildings_in_image(image, image_name, output_dir, writer,
+                                     save_intermediates, input_type, mask_polarity)
+
+def detect_buildings_in_image(image, image_name="image", output_dir=None, writer=None,
+                              save_intermediates=None, input_type='auto', mask_polarity='white',
+                              image_stem=None):
+    """
+    Detect buildings in an image already decoded into a NumPy array.
+    
+    Nothing is written to disk unless output_dir is given, in which case the
+    numbered image, building CSV and requested intermediates are written exactly
+    as process_single_image does.
+    
+    Parameters:
+    - image: Grayscale or BGR(A) image array, as returned by cv2.imread/imdecode
+    - image_name: File name (or relative path) reported in the summary
+    - image_stem: Stem to name the outputs after (default: output_stem(image_name))
+    - output_dir: Optional directory to save the numbered image and building CSV
+    - writer, save_intermediates, input_type, mask_polarity: As for process_single_image
+    
+    Returns:
+    - Tuple (summary, buildings_df, numbered_viz): the summary dictionary,
+      a DataFrame with one row per building and the numbered visualization
+    """
+    
+    # Convert to grayscale if needed
+    if len(image.shape) == 3:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = image
+    
+    if input_type == 'auto':
+        input_type = detect_input_type(gray)
+    
+    if input_type == 'mask':
+        # Binary masks already mark the buildings, no adaptive stage needed
+        binary = mask_to_binary(gray, mask_polarity)
+    else:
         # Adaptive thresholding
         binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
                                      cv2.THRESH_BINARY_INV, 15, 10)
+    
+    # Morphological cleanup
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+    cleaned = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel, iterations=2)
+    
+    # Distance transform method for building detection
+    dist_transform = cv2.distanceTransform(binary, cv2.DIST_L2, 5)
+    
+    # Find local maxima
+    kernel_max = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
+    local_maxima = cv2.morphologyEx(dist_transform, cv2.MORPH_TOPHAT, kernel_max)
+    
+    # Threshold to get peaks
+    _, peaks = cv2.threshold(local_maxima, 0.3 * local_maxima.max(), 255, cv2.THRESH_BINARY)
+    peaks = peaks.astype(np.uint8)
+    
+    # Find connected components of peaks
+    num_peaks, peak_labels = cv2.connectedComponents(peaks)
+    
+    # Number of buildings detected (subtract 1 for background)
+    buildings_detected = num_peaks - 1
+    
+    # Create numbered visualization
+    numbered_viz = cv2.cvtColor(binary, cv2.COLOR_GRAY2BGR)
+    
+    building_centers = []
+    building_count = 0
+    total_building_area = 0
+    
+    # Area and coordinate sums of every peak component in one pass over
+    # the peak pixels, rather than a full-image mask per building
+    peak_ys, peak_xs = np.nonzero(peak_labels)
+    peak_ids = peak_labels[peak_ys, peak_xs]
+    label_areas = np.bincount(peak_ids, minlength=num_peaks)
+    label_sum_y = np.bincount(peak_ids, weights=peak_ys, minlength=num_peaks)
+    label_sum_x = np.bincount(peak_ids, weights=peak_xs, minlength=num_peaks)
+    
+    # Process each building (skip background label 0)
+    for label in range(1, num_peaks):
+        building_area = label_areas[label]
         
-        # Morphological cleanup
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-        cleaned = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel, iterations=2)
-        
-        # Distance transform method for building detection
-        dist_transform = cv2.distanceTransform(binary, cv2.DIST_L2, 5)
-        
-        # Find local maxima
-        kernel_max = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
-        local_maxima = cv2.morphologyEx(dist_transform, cv2.MORPH_TOPHAT, kernel_max)
-        
-        # Threshold to get peaks
-        _, peaks = cv2.threshold(local_maxima, 0.3 * local_maxima.max(), 255, cv2.THRESH_BINARY)
-        peaks = peaks.astype(np.uint8)
-        
-        # Find connected components of peaks
-        num_peaks, peak_labels = cv2.connectedComponents(peaks)
-        
-        # Number of buildings detected (subtract 1 for background)
-        buildings_detected = num_peaks - 1
-        
-        # Create numbered visualization
-        numbered_viz = cv2.cvtColor(binary, cv2.COLOR_GRAY2BGR)
-        
-        building_centers = []
-        building_count = 0
-        total_building_area = 0
-        
-        # Process each building (skip background label 0)
-        for label in range(1, num_peaks):
-            # Find all pixels belonging to this building center
-            mask = (peak_labels == label)
+        if building_area > 0:
+            # Calculate centroid of the building center
+            cY = int(label_sum_y[label] / building_area)
+            cX = int(label_sum_x[label] / building_area)
             
-            if np.any(mask):
-                # Get coordinates of this building center
-                coords = np.where(mask)
-                
-                if len(coords[0]) > 0:
-                    # Calculate centroid of the building center
-                    cY = int(np.mean(coords[0]))
-                    cX = int(np.mean(coords[1]))
-                    
-                    building_centers.append((cX, cY, label))
-                    building_count += 1
-                    
-                    # Calculate building area (approximate using connected component area)
-                    building_area = np.sum(mask)
-                    total_building_area += building_area
-                    
-                    # Add number to the visualization with high contrast
-                    text_color = (255, 255, 255)  # White
-                    outline_color = (0, 0, 0)     # Black
-                    
-                    # Add thick black outline for visibility
-                    cv2.putText(numbered_viz, f'{building_count}', (cX-20, cY+8),
-                               cv2.FONT_HERSHEY_SIMPLEX, 0.6, outline_color, 3)
-                    cv2.putText(numbered_viz, f'{building_count}', (cX-20, cY+8),
-                               cv2.FONT_HERSHEY_SIMPLEX, 0.6, text_color, 2)
-                    
-                    # Draw a circle at building center
-                    cv2.circle(numbered_viz, (cX, cY), 3, (0, 255, 0), -1)
-        
-        # Save the numbered image
-        output_filename = f"numbered_{image_path.stem}.png"
+            building_centers.append((cX, cY, label))
+            building_count += 1
+            
+            # Calculate building area (approximate using connected component area)
+            total_building_area += building_area
+            
+            # Add number to the visualization with high contrast
+            text_color = (255, 255, 255)  # White
+            outline_color = (0, 0, 0)     # Black
+            
+            # Add thick black outline for visibility
+            cv2.putText(numbered_viz, f'{building_count}', (cX-20, cY+8),
+                       cv2.FONT_HERSHEY_SIMPLEX, 0.6, outline_color, 3)
+            cv2.putText(numbered_viz, f'{building_count}', (cX-20, cY+8),
+                       cv2.FONT_HERSHEY_SIMPLEX, 0.6, text_color, 2)
+            
+            # Draw a circle at building center
+            cv2.circle(numbered_viz, (cX, cY), 3, (0, 255, 0), -1)
+    
+    # Save the numbered image
+    if image_stem is None:
+        image_stem = output_stem(image_name)
+    output_filename = None
+    if output_dir is not None:
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        if writer is None:
+            writer = OutputWriter(max_workers=0)
+        output_filename = writer.image_filename(image_stem)
         output_path = output_dir / output_filename
-        cv2.imwrite(str(output_path), numbered_viz)
+        writer.write_image(output_path, numbered_viz)
+    
+    # Save intermediate rasters for downstream tools
+    if save_intermediates and output_dir is not None:
+        intermediates = {
+            'binary': binary,
+            'dist_transform': dist_transform,
+            'peak_labels': peak_labels
+        }
+        intermediates_dir = output_dir / "intermediates"
+        intermediates_dir.mkdir(exist_ok=True)
+        for name in save_intermediates:
+            writer.write_array(intermediates_dir / f"{image_stem}_{name}.npy", intermediates[name])
+    
+    # Create individual building data for CSV
+    individual_buildings = []
+    for i, (cX, cY, label) in enumerate(building_centers, 1):
+        individual_buildings.append({
+            'building_number': i,
+            'center_x': cX,
+            'center_y': cY,
+            'area_pixels': label_areas[label],
+            'label_id': label
+        })
+    
+    buildings_df = pd.DataFrame(individual_buildings, columns=BUILDING_CSV_COLUMNS)
+    
+    # Save individual CSV for this image
+    csv_filename = None
+    if individual_buildings and output_dir is not None:
+        csv_filename = f"{image_stem}_buildings.csv"
+        csv_path = output_dir / csv_filename
+        writer.write_csv(csv_path, buildings_df)
+    
+    # Calculate total white pixels (building area)
+    total_white_pixels = np.sum(binary == 255)
+    
+    summary = {
+        'image_filename': image_name,
+        'building_count': building_count,
+        'total_building_area_pixels': total_white_pixels,
+        'building_centers_area_pixels': total_building_area,
+        'coverage_percentage': (total_building_area / total_white_pixels * 100) if total_white_pixels > 0 else 0,
+        'output_image': output_filename,
+        'individual_csv': csv_filename,
+        'image_width': binary.shape[1],
+        'image_height': binary.shape[0],
+        'input_type': input_type
+    }
+    
+    # Return results
+    return summary, buildings_df, numbered_viz
+
+def load_intermediates(output_dir, image_stem, names=INTERMEDIATE_ARRAYS):
+    """
+    Map intermediate rasters saved by process_single_image back into memory.
+    
+    The arrays are opened with np.load(mmap_mode='r'), so nothing is copied or
+    read until it is accessed, and several processes can share the same file.
+    
+    Parameters:
+    - output_dir: Directory passed to process_single_image (e.g. output/images)
+    - image_stem: Output stem of the image (see output_stem), i.e. its file
+      name without extension for images at the top of the input folder
+    - names: Intermediates to load (default: all that were saved)
+    
+    Returns:
+    - Dictionary mapping each name to a read-only memory-mapped array
+    """
+    
+    intermediates_dir = Path(output_dir) / "intermediates"
+    arrays = {}
+    for name in names:
+        npy_path = intermediates_dir / f"{image_stem}_{name}.npy"
+        if npy_path.exists():
+            arrays[name] = np.load(npy_path, mmap_mode='r')
+    
+    return arrays
+
+def merge_shard_results(output_folder, shard_folders=None, input_folder_path=None,
+                        recursive=False, include=None, exclude=None, manifest=None):
+    """
+    Merge the results of a sharded batch run into one building_detection_results.csv.
+    
+    Parameters:
+    - output_folder: Folder to write the merged results into
+    - shard_folders: Folders containing shard outputs (defaults to output_folder);
+      per-image PNG/CSV files from other folders are copied into output_folder/images
+    - input_folder_path: Optional original input folder, used to check that
+      every image was processed by some shard
+    - recursive, include, exclude, manifest: The discovery options the shards
+      were run with, so the check expects the same images
+    
+    Returns:
+    - DataFrame with merged results (empty if the shards are inconsistent)
+    """
+    
+    output_path = Path(output_folder)
+    shard_paths = [Path(f) for f in (shard_folders or [output_folder])]
+    
+    # Collect shard summary files from every folder
+    shard_frames = []
+    shard_counts = set()
+    seen_shards = {}
+    for shard_path in shard_paths:
+        if not shard_path.is_dir():
+            print(f"✗ Shard folder not found: {shard_path}")
+            return pd.DataFrame()
         
-        # Create individual building data for CSV
-        individual_buildings = []
-        for i, (cX, cY, label) in enumerate(building_centers, 1):
-            # Calculate individual building area (approximate using connected component)
-            mask = (peak_labels == label)
-            building_area = np.sum(mask)
+        for csv_file in sorted(shard_path.iterdir()):
+            match = SHARD_CSV_PATTERN.match(csv_file.name)
+            if not match:
+                continue
             
-            individual_buildings.append({
-                'building_number': i,
-                'center_x': cX,
-                'center_y': cY,
-                'area_pixels': building_area,
-                'label_id': label
-            })
-        
-        # Save individual CSV for this image
-        if individual_buildings:
-            csv_filename = f"{image_path.stem}_buildings.csv"
-            csv_path = output_dir / csv_filename
-            buildings_df = pd.DataFrame(individual_buildings)
-            buildings_df.to_csv(csv_path, index=False)
-        
-        # Calculate total white pixels (building area)
-        total_white_pixels = np.sum(binary == 255)
-        
-        # Return results
-        return {
-            'image_filename': image_path.name,
-            'building_count': building_count,
-            'total_building_area_pixels': total_white_pixels,
-            'building_centers_area_pixels': total_building_area,
-            'coverage_percentage': (total_building_area / total_white_pixels * 100) if total_white_pixels > 0 else 0,
-            'output_image': output_filename,
-            'individual_csv': csv_filename if individual_buildings else None,
-            'image_width': binary.shape[1],
-            'image_height': binary.shape[0]
-        }
+            shard_index, shard_count = int(match.group(1)), int(match.group(2))
+            if shard_index in seen_shards:
+                print(f"✗ Shard {shard_index}/{shard_count} found twice: "
+                      f"{seen_shards[shard_index]} and {csv_file}")
+                return pd.DataFrame()
+            seen_shards[shard_index] = csv_file
+            shard_counts.add(shard_count)
+            
+            shard_df = pd.read_csv(csv_file, float_precision="round_trip")
+            shard_df['_shard_index'] = shard_index
+            shard_df['_source_images'] = str(shard_path / "images")
+            shard_frames.append(shard_df)
+    
+    if not shard_frames:
+        print(f"✗ No shard result files found in: {', '.join(str(p) for p in shard_paths)}")
+        return pd.DataFrame()
+    
+    if len(shard_counts) > 1:
+        print(f"✗ Shard results come from runs with different shard counts: {sorted(shard_counts)}")
+        return pd.DataFrame()
+    
+    shard_count = shard_counts.pop()
+    missing_shards = sorted(set(range(shard_count)) - set(seen_shards))
+    if missing_shards:
+        print(f"✗ Missing results for shard(s): {', '.join(f'{i}/{shard_count}' for i in missing_shards)}")
+        return pd.DataFrame()
+    
+    df = pd.concat(shard_frames, ignore_index=True)
+    
+    # Every image must appear exactly once across all shards
+    duplicated = df['image_filename'][df['image_filename'].duplicated()].unique()
+    if len(duplicated) > 0:
+        print(f"✗ {len(duplicated)} image(s) appear in more than one shard, e.g.: "
+              f"{', '.join(duplicated[:5])}")
+        return pd.DataFrame()
+    
+    misplaced = [name for name, index in zip(df['image_filename'], df['_shard_index'])
+                 if shard_of(name, shard_count) != index]
+    if misplaced:
+        print(f"⚠ {len(misplaced)} image(s) are not in the shard their name hashes to, e.g.: "
+              f"{', '.join(misplaced[:5])}")
+    
+    if input_folder_path is not None:
+        if manifest is not None and not os.path.isfile(manifest):
+            print(f"✗ Manifest file not found: {manifest}")
+            return pd.DataFrame()
+        expected = {relative_image_name(f, input_folder_path)
+                    for f in discover_images(input_folder_path, recursive, include, exclude, manifest)}
+        missing_images = sorted(expected - set(df['image_filename']))
+        if missing_images:
+            print(f"✗ {len(missing_images)} image(s) from {input_folder_path} have no results, e.g.: "
+                  f"{', '.join(missing_images[:5])}")
+            return pd.DataFrame()
+    
+    # Gather the per-image outputs into a single images folder
+    images_output_path = output_path / "images"
+    images_output_path.mkdir(parents=True, exist_ok=True)
+    missing_outputs = []
+    for _, row in df.iterrows():
+        source_dir = Path(row['_source_images'])
+        for column in ('output_image', 'individual_csv'):
+            filename = row[column]
+            if pd.isna(filename):
+                continue
+            
+            source_file = source_dir / filename
+            target_file = images_output_path / filename
+            if not source_file.exists():
+                missing_outputs.append(str(source_file))
+            elif source_file.resolve() != target_file.resolve():
+                shutil.copy2(source_file, target_file)
         
-    except Exception as e:
-        print(f"Error processing {image_path}: {str(e)}")
-        return None
+        # Downscaled previews and intermediate rasters are optional, copy them when present
+        optional_files = [(source_dir / f"preview_{row['output_image']}", images_output_path)]
+        for name in INTERMEDIATE_ARRAYS:
+            npy_name = f"{numbered_image_stem(row['output_image'])}_{name}.npy"
+            optional_files.append((source_dir / "intermediates" / npy_name, images_output_path / "intermediates"))
+        for source_file, target_dir in optional_files:
+            target_file = target_dir / source_file.name
+            if source_file.exists() and source_file.resolve() != target_file.resolve():
+                target_dir.mkdir(exist_ok=True)
+                shutil.copy2(source_file, target_file)
+    
+    if missing_outputs:
+        print(f"⚠ {len(missing_outputs)} per-image output file(s) are missing, e.g.: "
+              f"{', '.join(missing_outputs[:5])}")
+    
+    df = df.drop(columns=['_shard_index', '_source_images'])
+    df = df.sort_values('image_filename', ignore_index=True)
+    csv_path = output_path / RESULTS_CSV_NAME
+    df.to_csv(csv_path, index=False)
+    
+    print(f"\n✓ Merged {shard_count} shard(s) into: {csv_path}")
+    print(f"Total images processed: {len(df)}")
+    print(f"Total buildings detected: {df['building_count'].sum()}")
+    
+    return df
 
 def create_summary_visualization(csv_path):
     """
@@ -267,19 +704,122 @@ def create_summary_visualization(csv_path):
     except Exception as e:
         print(f"Error creating summary visualization: {str(e)}")
 
+def parse_intermediates(names):
+    """Parse a comma-separated list of intermediate names ('all' for every one)"""
+    
+    names = [name.strip() for name in names.split(',') if name.strip()]
+    if names == ['all']:
+        return list(INTERMEDIATE_ARRAYS)
+    
+    unknown = [name for name in names if name not in INTERMEDIATE_ARRAYS]
+    if unknown:
+        raise ValueError(f"Unknown intermediate(s) {', '.join(unknown)}; "
+                         f"choose from: {', '.join(INTERMEDIATE_ARRAYS)} or 'all'")
+    
+    return names
+
+def parse_tolerance(value):
+    """Parse a match tolerance in pixels (0 or more)"""
+    
+    tolerance = float(value)
+    if not tolerance >= 0:
+        raise argparse.ArgumentTypeError(f"tolerance must be 0 or more, got '{value}'")
+    
+    return tolerance
+
+def parse_workers(value):
+    """Parse a number of concurrent images (1 or more)"""
+    
+    workers = int(value)
+    if workers < 1:
+        raise argparse.ArgumentTypeError(f"workers must be 1 or more, got '{value}'")
+    
+    return workers
+
+def parse_thread_count(value):
+    """Parse a thread count (0 or more)"""
+    
+    threads = int(value)
+    if threads < 0:
+        raise argparse.ArgumentTypeError(f"thread count must be 0 or more, got '{value}'")
+    
+    return threads
+
+def parse_memory_budget(value):
+    """Parse a RAM budget in MB (more than 0)"""
+    
+    budget = float(value)
+    if not budget > 0:
+        raise argparse.ArgumentTypeError(f"memory budget must be more than 0 MB, got '{value}'")
+    
+    return budget
+
 # Example usage function
-def main():
+def main(argv=None):
     """
     Main function to demonstrate usage
+    
+    Usage:
+    - python building_detector.py [input_folder] [output_folder] [--shard i/N]
+    - python building_detector.py merge output_folder [shard_folder ...] [--input input_folder] [--recursive]
+    - python building_detector.py compare earlier_output later_output [--output changes] [--tolerance 5]
     """
     
-    # Example usage
-    input_folder = "Massachusetts labels"  # Change this to your input folder
-    output_folder = "output"
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] == "merge":
+        return merge_main(argv[1:])
+    if argv and argv[0] == "compare":
+        return compare_main(argv[1:])
+    
+    parser = argparse.ArgumentParser(description="Detect buildings in a folder of images")
+    parser.add_argument("input_folder", nargs="?", default="Massachusetts labels",
+                        help="Folder containing images (default: 'Massachusetts labels')")
+    parser.add_argument("output_folder", nargs="?", default="output",
+                        help="Folder to write results to (default: 'output')")
+    parser.add_argument("--shard", type=parse_shard, default=None, metavar="i/N",
+                        help="Only process shard i of N (0 <= i < N); combine shards with 'merge'")
+    parser.add_argument("--recursive", action="store_true",
+                        help="Also process images in subfolders")
+    parser.add_argument("--include", action="append", default=None, metavar="GLOB",
+                        help="Only process images matching this pattern (repeatable)")
+    parser.add_argument("--exclude", action="append", default=None, metavar="GLOB",
+                        help="Skip images matching this pattern (repeatable)")
+    parser.add_argument("--manifest", default=None,
+                        help="File listing image paths to process, one per line")
+    parser.add_argument("--sort", action="store_true",
+                        help="Process images in sorted order (waits for enumeration to finish)")
+    parser.add_argument("--workers", type=parse_workers, default=1,
+                        help="Maximum number of images processed concurrently (default: 1)")
+    parser.add_argument("--memory-budget", type=parse_memory_budget, default=None, metavar="MB",
+                        help="RAM budget in MB; images are only started while their estimated memory fits")
+    parser.add_argument("--opencv-threads", type=parse_thread_count, default=None,
+                        help="OpenCV internal thread count (default: cores / workers with --workers > 1)")
+    parser.add_argument("--image-format", choices=["png", "jpg", "webp"], default="png",
+                        help="Codec for the numbered images (default: png)")
+    parser.add_argument("--image-quality", type=int, default=None,
+                        help="PNG compression level 0-9, or JPEG/WebP quality 0-100")
+    parser.add_argument("--preview-size", type=int, default=None, metavar="PIXELS",
+                        help="Also write preview_*.<ext> images with this maximum side length")
+    parser.add_argument("--writer-threads", type=parse_thread_count, default=2,
+                        help="Background threads writing images and CSVs (0 = write inline)")
+    parser.add_argument("--save-intermediates", type=parse_intermediates, default=None, metavar="NAMES",
+                        help="Save intermediate rasters as memory-mappable .npy files: "
+                             "comma-separated from binary,dist_transform,peak_labels or 'all'")
+    parser.add_argument("--input-type", choices=["auto", "image", "mask"], default="auto",
+                        help="'mask' skips adaptive thresholding for binary building masks; "
+                             "'auto' detects masks from a pixel sample (default: auto)")
+    parser.add_argument("--mask-polarity", choices=["white", "black"], default="white",
+                        help="Value of buildings in binary masks (default: white)")
+    args = parser.parse_args(argv)
+    
+    input_folder = args.input_folder
+    output_folder = args.output_folder
     
     print("=== BUILDING DETECTION BATCH PROCESSOR ===")
     print(f"Input folder: {input_folder}")
     print(f"Output folder: {output_folder}")
+    if args.shard is not None:
+        print(f"Shard: {args.shard[0]}/{args.shard[1]}")
     
     # Check if input folder exists
     if not os.path.exists(input_folder):
@@ -287,19 +827,103 @@ def main():
         print("Please provide a valid folder path containing images.")
         return
     
+    if args.manifest is not None and not os.path.isfile(args.manifest):
+        print(f"Error: Manifest file '{args.manifest}' does not exist.")
+        return
+    
+    try:
+        writer = OutputWriter(args.image_format, args.image_quality, args.preview_size,
+                              max_workers=args.writer_threads)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return
+    
     # Process all images in the folder
-    results_df = detect_buildings_in_folder(input_folder, output_folder)
+    with writer:
+        results_df = detect_buildings_in_folder(input_folder, output_folder, shard=args.shard,
+                                                workers=args.workers,
+                                                memory_budget_mb=args.memory_budget,
+                                                opencv_threads=args.opencv_threads,
+                                                writer=writer,
+                                                recursive=args.recursive,
+                                                include=args.include,
+                                                exclude=args.exclude,
+                                                manifest=args.manifest,
+                                                sort=args.sort,
+                                                save_intermediates=args.save_intermediates,
+                                                input_type=args.input_type,
+                                                mask_polarity=args.mask_polarity)
     
-    if not results_df.empty:
+    if results_df.empty:
+        print("\n✗ No images were processed successfully.")
+    elif writer.failures:
+        print(f"\n✗ {len(writer.failures)} output file(s) could not be written; "
+              f"the images they belong to are left out of the results.")
+    elif args.shard is not None:
+        print(f"\n✓ Shard {args.shard[0]}/{args.shard[1]} completed successfully!")
+        print(f"✓ Run 'python building_detector.py merge' once all shards are done")
+    else:
         # Create summary visualization
-        csv_path = os.path.join(output_folder, "building_detection_results.csv")
+        csv_path = os.path.join(output_folder, RESULTS_CSV_NAME)
         create_summary_visualization(csv_path)
         
         print(f"\n✓ All processing completed successfully!")
         print(f"✓ Check the '{output_folder}' folder for results")
         print(f"✓ Individual CSV files created for each image with building details")
-    else:
-        print("\n✗ No images were processed successfully.")
+
+def merge_main(argv):
+    """
+    Command line entry point for merging the results of a sharded run
+    """
+    
+    parser = argparse.ArgumentParser(prog="building_detector.py merge",
+                                     description="Merge shard results into one building_detection_results.csv")
+    parser.add_argument("output_folder", help="Folder to write the merged results to")
+    parser.add_argument("shard_folders", nargs="*",
+                        help="Folders with shard outputs (default: output_folder)")
+    parser.add_argument("--input", dest="input_folder", default=None,
+                        help="Original input folder, used to check for missing images")
+    parser.add_argument("--recursive", action="store_true",
+                        help="The shards also processed images in subfolders")
+    parser.add_argument("--include", action="append", default=None, metavar="GLOB",
+                        help="Only expect images matching this pattern (repeatable)")
+    parser.add_argument("--exclude", action="append", default=None, metavar="GLOB",
+                        help="Don't expect images matching this pattern (repeatable)")
+    parser.add_argument("--manifest", default=None,
+                        help="Manifest the shards were run with, listing the expected images")
+    args = parser.parse_args(argv)
+    
+    print("=== MERGING SHARD RESULTS ===")
+    merged_df = merge_shard_results(args.output_folder, args.shard_folders or None, args.input_folder,
+                                    recursive=args.recursive, include=args.include,
+                                    exclude=args.exclude, manifest=args.manifest)
+    
+    if merged_df.empty:
+        print("\n✗ Shard results were not merged.")
+
+def compare_main(argv):
+    """
+    Command line entry point for comparing two runs over the same tiles
+    """
+    
+    parser = argparse.ArgumentParser(prog="building_detector.py compare",
+                                     description="Find buildings added or removed between two runs")
+    parser.add_argument("earlier_folder", help="Output folder of the earlier run")
+    parser.add_argument("later_folder", help="Output folder of the later run")
+    parser.add_argument("--output", dest="output_folder", default="changes",
+                        help="Folder to write the change CSVs to (default: 'changes')")
+    parser.add_argument("--tolerance", type=parse_tolerance, default=5.0,
+                        help="Maximum center distance in pixels for a building to match; "
+                             "0 matches exact positions only (default: 5)")
+    args = parser.parse_args(argv)
+    
+    print("=== BUILDING CHANGE DETECTION ===")
+    print(f"Earlier run: {args.earlier_folder}")
+    print(f"Later run: {args.later_folder}")
+    try:
+        compare_runs(args.earlier_folder, args.later_folder, args.output_folder, args.tolerance)
+    except Exception as e:
+        print(f"\n✗ Runs could not be compared: {str(e)}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -4,7 +4,15 @@
 DEFAULT_INPUT_FOLDER = "Massachusetts labels"
 DEFAULT_OUTPUT_FOLDER = "output"
 
+# Batch Scheduling
+WORKERS = 1                 # Images processed concurrently
+MEMORY_BUDGET_MB = None     # RAM budget for concurrent images (None = no limit)
+OPENCV_THREADS = None       # OpenCV internal threads (None = cores / workers when workers > 1)
+
 # Image Processing Parameters
+INPUT_TYPE = 'auto'         # 'auto', 'image' (adaptive threshold) or 'mask' (binary building mask)
+MASK_POLARITY = 'white'     # Value of buildings in binary masks: 'white' or 'black'
+INPUT_TYPE_SAMPLE_PIXELS = 65536  # Pixels sampled to detect binary masks
 ADAPTIVE_THRESH_BLOCK_SIZE = 15
 ADAPTIVE_THRESH_C = 10
 
@@ -30,6 +38,16 @@ OUTLINE_THICKNESS = 3
 CIRCLE_RADIUS = 3
 CIRCLE_COLOR = (0, 255, 0)    # Green
 
+# Output Writing
+OUTPUT_IMAGE_CODEC = 'png'  # 'png', 'jpg' or 'webp'
+OUTPUT_IMAGE_QUALITY = None # PNG compression 0-9 or JPEG/WebP quality 0-100 (None = OpenCV default)
+PREVIEW_MAX_SIZE = None     # Longest side of preview_* images in pixels (None = no previews)
+WRITER_THREADS = 2          # Background threads for image/CSV writes (0 = write inline)
+SAVE_INTERMEDIATES = []     # Any of 'binary', 'dist_transform', 'peak_labels' to save as .npy
+
+# Change Detection
+CHANGE_MATCH_TOLERANCE = 5.0   # Max center distance (pixels) for a building to match between runs
+
 # Image Quality Settings
 OUTPUT_DPI = 300
 FIGURE_SIZE = (25, 25)
@@ -48,7 +66,8 @@ CSV_COLUMNS = [
     'output_image',
     'individual_csv',
     'image_width',
-    'image_height'
+    'image_height',
+    'input_type'
 ]
 
 # Individual Building CSV Columns
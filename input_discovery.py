@@ -0,0 +1,167 @@
+"""
+Input discovery for batch building detection.
+
+Image paths are streamed with os.scandir (which usually knows whether an entry
+is a file without an extra stat call) or read line by line from a manifest, so
+processing can start on the first image while enumeration is still running.
+"""
+
+import os
+from fnmatch import fnmatch
+from pathlib import Path, PurePosixPath
+
+# Supported image extensions
+IMAGE_EXTENSIONS = {'.tif', '.tiff', '.jpg', '.jpeg', '.png', '.bmp'}
+
+def iter_image_files(folder, recursive=False, include=None, exclude=None,
+                     extensions=IMAGE_EXTENSIONS):
+    """
+    Yield image files in a folder as they are found.
+
+    Parameters:
+    - folder: Folder to scan
+    - recursive: Also scan subfolders
+    - include: Optional list of glob patterns; only matching files are yielded
+    - exclude: Optional list of glob patterns; matching files are skipped
+    - extensions: Lower-case file extensions to accept
+
+    Patterns are matched against the file name and against the path relative
+    to folder with '/' as separator (e.g. '*_15.tif' or '2019/*').
+
+    Returns:
+    - Generator of Path objects
+    """
+
+    pending = [Path(folder)]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                subfolders = []
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            subfolders.append(Path(entry.path))
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if os.path.splitext(entry.name)[1].lower() not in extensions:
+                        continue
+
+                    path = Path(entry.path)
+                    if _matches(path.relative_to(folder).as_posix(), include, exclude):
+                        yield path
+        except OSError as e:
+            print(f"✗ Could not read folder {directory}: {str(e)}")
+            continue
+
+        # Depth-first, visiting subfolders in the order they were listed
+        pending.extend(reversed(subfolders))
+
+def iter_manifest(manifest_path, base_folder=None, include=None, exclude=None,
+                  extensions=IMAGE_EXTENSIONS):
+    """
+    Yield image paths listed in a manifest file, one path per line.
+
+    Blank lines and lines starting with '#' are ignored. Relative paths are
+    resolved against base_folder (default: the manifest's folder). The file is
+    read lazily, so manifests with millions of entries are never held in memory.
+
+    Returns:
+    - Generator of Path objects
+    """
+
+    base_path = Path(base_folder) if base_folder is not None else Path(manifest_path).parent
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            entry = line.strip()
+            if not entry or entry.startswith('#'):
+                continue
+
+            path = Path(entry)
+            if path.suffix.lower() not in extensions:
+                continue
+            if not _matches(path.as_posix(), include, exclude):
+                continue
+
+            yield path if path.is_absolute() else base_path / path
+
+def discover_images(input_folder, recursive=False, include=None, exclude=None,
+                    manifest=None, sort=False):
+    """
+    Yield the images to process from a folder or a manifest.
+
+    Parameters:
+    - input_folder: Folder to scan (and base for relative manifest entries)
+    - recursive: Also scan subfolders
+    - include, exclude: Optional lists of glob patterns (see iter_image_files)
+    - manifest: Optional manifest file listing the images instead of scanning
+    - sort: Sort the paths for a deterministic order; this has to enumerate
+      everything before the first path is yielded
+
+    Returns:
+    - Generator of Path objects
+    """
+
+    if manifest is not None:
+        paths = iter_manifest(manifest, input_folder, include, exclude)
+    else:
+        paths = iter_image_files(input_folder, recursive, include, exclude)
+
+    if sort:
+        paths = iter(sorted(paths))
+
+    yield from paths
+
+def relative_image_name(path, input_folder):
+    """
+    Name of an image relative to the input folder, with '/' as separator
+    (e.g. '2019/tile_15.tif'). Images outside the folder, such as absolute
+    manifest entries, are named by their file name.
+    """
+
+    path = Path(path)
+    try:
+        return path.relative_to(input_folder).as_posix()
+    except ValueError:
+        return path.name
+
+def output_stem(image_name, keep_extension=False):
+    """
+    Stem used to name the output files of an image: its relative name without
+    the extension, with subfolders flattened into '__' (e.g. '2019/tile_15.tif'
+    becomes '2019__tile_15'), so images in different subfolders never collide.
+    With keep_extension the extension stays ('2019__tile_15.tif'), for images
+    that share their stem with another image (see shares_stem).
+    """
+
+    path = PurePosixPath(image_name)
+    if not keep_extension:
+        path = path.with_suffix('')
+    return str(path).replace('/', '__')
+
+def shares_stem(path, extensions=IMAGE_EXTENSIONS):
+    """
+    Check whether another supported image with the same stem sits next to
+    path (e.g. a.tif and a.png). Only the candidate names are looked up, so
+    the answer doesn't depend on listing order or on which images a run or
+    shard processes.
+    """
+
+    path = Path(path)
+    for extension in extensions:
+        for suffix in (extension, extension.upper()):
+            if suffix == path.suffix:
+                continue
+            candidate = path.with_suffix(suffix)
+            if candidate.is_file() and not os.path.samefile(candidate, path):
+                return True
+    return False
+
+def _matches(relative_path, include, exclude):
+    name = relative_path.rsplit('/', 1)[-1]
+    if include and not any(fnmatch(relative_path, p) or fnmatch(name, p) for p in include):
+        return False
+    if exclude and any(fnmatch(relative_path, p) or fnmatch(name, p) for p in exclude):
+        return False
+    return True
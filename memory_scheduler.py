@@ -0,0 +1,335 @@
+"""
+Memory-budgeted scheduling for batch building detection.
+
+Image dimensions are read from the file header (PNG, JPEG, TIFF, BMP) without
+decoding any pixels, the peak memory of process_single_image is estimated with
+a per-stage model, and jobs are only admitted while the estimated total of all
+running jobs stays under a RAM budget.
+"""
+
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import cv2
+
+# Bytes per pixel held by each stage of process_single_image. All of these
+# arrays stay alive until the function returns, and the visualization (plus
+# any saved intermediates) stays queued on the OutputWriter until it is
+# written, so the peak is their sum.
+STAGE_BYTES_PER_PIXEL = {
+    'gray': 1,              # uint8 grayscale (skipped for single-channel 8-bit input)
+    'binary': 1,            # uint8 adaptive threshold result (saved as an intermediate)
+    'cleaned': 1,           # uint8 morphological opening
+    'dist_transform': 4,    # float32 distance map (saved as an intermediate)
+    'local_maxima': 4,      # float32 top-hat
+    'peaks_float': 4,       # float32 output of cv2.threshold before astype
+    'peaks': 1,             # uint8 peaks
+    'peak_labels': 4,       # int32 connected component labels (saved as an intermediate)
+    'numbered_viz': 3,      # uint8 BGR visualization
+    'encode_buffer': 3,     # encoder working copy of the visualization (on the writer thread)
+}
+
+# Headroom for allocator fragmentation and small temporaries
+MEMORY_OVERHEAD_FACTOR = 1.2
+
+def read_image_header(image_path):
+    """
+    Read image dimensions from the file header without decoding the image.
+
+    Parameters:
+    - image_path: Path to a PNG, JPEG, TIFF or BMP file
+
+    Returns:
+    - Dictionary with width, height, channels and bytes_per_sample,
+      or None if the format is not recognised
+    """
+
+    try:
+        with open(image_path, 'rb') as f:
+            head = f.read(32)
+
+            if head.startswith(b'\x89PNG\r\n\x1a\n'):
+                return _read_png_header(head)
+            if head[:2] == b'\xff\xd8':
+                return _read_jpeg_header(f)
+            if head[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'):
+                return _read_tiff_header(f, head)
+            if head[:2] == b'BM':
+                return _read_bmp_header(head)
+    except (OSError, struct.error):
+        pass
+
+    return None
+
+def _read_png_header(head):
+    # IHDR is always the first chunk: width, height, bit depth, colour type
+    width, height, bit_depth, color_type = struct.unpack('>IIBB', head[16:26])
+    channels = {0: 1, 2: 3, 3: 3, 4: 4, 6: 4}.get(color_type, 4)
+    return {
+        'width': width,
+        'height': height,
+        'channels': channels,
+        'bytes_per_sample': 2 if bit_depth == 16 else 1
+    }
+
+def _read_jpeg_header(f):
+    # Walk the marker segments until a start-of-frame marker
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0xFF:
+            f.seek(-1, os.SEEK_CUR)
+            continue
+        if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+            continue
+
+        length = struct.unpack('>H', f.read(2))[0]
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            precision, height, width, components = struct.unpack('>BHHB', f.read(6))
+            return {
+                'width': width,
+                'height': height,
+                'channels': 1 if components == 1 else 3,
+                'bytes_per_sample': 2 if precision > 8 else 1
+            }
+        f.seek(length - 2, os.SEEK_CUR)
+
+def _read_tiff_header(f, head):
+    endian = '<' if head[:2] == b'II' else '>'
+    big_tiff = struct.unpack(endian + 'H', head[2:4])[0] == 43
+
+    if big_tiff:
+        ifd_offset = struct.unpack(endian + 'Q', head[8:16])[0]
+        count_format, entry_format, entry_size = 'Q', 'HHQ8s', 20
+    else:
+        ifd_offset = struct.unpack(endian + 'I', head[4:8])[0]
+        count_format, entry_format, entry_size = 'H', 'HHI4s', 12
+
+    f.seek(ifd_offset)
+    count_size = struct.calcsize(count_format)
+    num_entries = struct.unpack(endian + count_format, f.read(count_size))[0]
+    entries = f.read(num_entries * entry_size)
+
+    tags = {}
+    for i in range(num_entries):
+        tag, value_type, value_count, value = struct.unpack(
+            endian + entry_format, entries[i * entry_size:(i + 1) * entry_size])
+        if tag not in (256, 257, 258, 277):
+            continue
+        # SHORT values are left-justified in the value field, LONG fill it
+        if value_type == 3:
+            tags[tag] = struct.unpack(endian + 'H', value[:2])[0]
+        elif value_type == 4:
+            tags[tag] = struct.unpack(endian + 'I', value[:4])[0]
+        elif value_type == 16:
+            tags[tag] = struct.unpack(endian + 'Q', value[:8])[0]
+        if tag == 258 and value_count * 2 > len(value):
+            # One BitsPerSample per channel, stored out of line; they share one depth in practice
+            f.seek(struct.unpack(endian + ('Q' if big_tiff else 'I'), value)[0])
+            tags[tag] = struct.unpack(endian + 'H', f.read(2))[0]
+
+    if 256 not in tags or 257 not in tags:
+        return None
+
+    return {
+        'width': tags[256],
+        'height': tags[257],
+        'channels': tags.get(277, 1),
+        'bytes_per_sample': max(1, tags.get(258, 8) // 8)
+    }
+
+def _read_bmp_header(head):
+    dib_size = struct.unpack('<I', head[14:18])[0]
+    if dib_size == 12:
+        width, height = struct.unpack('<HH', head[18:22])
+        bit_count = struct.unpack('<H', head[24:26])[0]
+    else:
+        width, height = struct.unpack('<ii', head[18:26])
+        bit_count = struct.unpack('<H', head[28:30])[0]
+    return {
+        'width': abs(width),
+        'height': abs(height),
+        'channels': 4 if bit_count == 32 else 3,
+        'bytes_per_sample': 1
+    }
+
+def estimate_peak_memory(width, height, channels=3, bytes_per_sample=1):
+    """
+    Estimate the peak memory (bytes) process_single_image needs for one image.
+
+    Parameters:
+    - width, height: Image dimensions in pixels
+    - channels: Number of channels of the decoded image
+    - bytes_per_sample: 1 for 8-bit images, 2 for 16-bit images
+
+    Returns:
+    - Estimated peak memory in bytes
+    """
+
+    pixels = width * height
+    decoded = channels * bytes_per_sample
+    stages = dict(STAGE_BYTES_PER_PIXEL)
+    if channels == 1 and bytes_per_sample == 1:
+        stages['gray'] = 0
+
+    return int(pixels * (decoded + sum(stages.values())) * MEMORY_OVERHEAD_FACTOR)
+
+class MemoryBudgetScheduler:
+    """
+    Run jobs on a thread pool, admitting a job only while the estimated memory
+    of all running jobs stays under a budget.
+
+    A job whose estimate exceeds the whole budget (or whose size is unknown) is
+    run on its own once everything else has finished, so it can never be starved.
+    A job's memory stays reserved until the writes it queued have finished, so
+    buffers waiting on the writer are counted against the budget too.
+    """
+
+    def __init__(self, max_workers=None, memory_budget_bytes=None, opencv_threads=None):
+        if max_workers is not None and max_workers < 1:
+            raise ValueError(f"max_workers must be 1 or more, got {max_workers}")
+        if memory_budget_bytes is not None and memory_budget_bytes <= 0:
+            raise ValueError(f"memory_budget_bytes must be more than 0, got {memory_budget_bytes}")
+
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count() or 1
+        self.memory_budget_bytes = memory_budget_bytes
+
+        # Each worker runs OpenCV calls in parallel already; keep the total
+        # number of OpenCV threads close to the number of cores. The setting is
+        # process-wide, so it is only applied while run() is going
+        if opencv_threads is None and self.max_workers > 1:
+            opencv_threads = max(1, (os.cpu_count() or 1) // self.max_workers)
+        self.opencv_threads = opencv_threads
+
+        self._condition = threading.Condition()
+        self._reserved_bytes = 0
+        self._running = 0
+
+    def job_cost(self, image_path):
+        """Estimated peak memory for one image, or None if its header can't be read"""
+
+        header = read_image_header(image_path)
+        if header is None:
+            return None
+        return estimate_peak_memory(header['width'], header['height'],
+                                    header['channels'], header['bytes_per_sample'])
+
+    def _admit(self, cost):
+        with self._condition:
+            while not self._can_admit(cost):
+                self._condition.wait()
+            self._running += 1
+            self._reserved_bytes += cost
+
+    def _can_admit(self, cost):
+        if self._running == 0 and self._reserved_bytes == 0:
+            return True
+        if self._running >= self.max_workers:
+            return False
+        if self.memory_budget_bytes is None:
+            return True
+        return self._reserved_bytes + cost <= self.memory_budget_bytes
+
+    def _finish(self):
+        with self._condition:
+            self._running -= 1
+            self._condition.notify_all()
+
+    def _release(self, cost):
+        with self._condition:
+            self._reserved_bytes -= cost
+            self._condition.notify_all()
+
+    def _release_after(self, futures, cost):
+        # Release the reservation once the last of the job's writes is done
+        if not futures:
+            self._release(cost)
+            return
+
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def write_done(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self._release(cost)
+
+        for future in futures:
+            future.add_done_callback(write_done)
+
+    def run(self, func, image_paths, writer=None):
+        """
+        Apply func to every image path, yielding (image_path, result, error)
+        tuples in completion order.
+
+        Image paths are consumed lazily, so enumeration can continue while
+        earlier images are being processed. If func queues writes on writer
+        (an OutputWriter), the job's memory stays reserved until they finish.
+        OpenCV's thread count is restored when the run finishes.
+        """
+
+        previous_opencv_threads = cv2.getNumThreads()
+        if self.opencv_threads is not None:
+            cv2.setNumThreads(self.opencv_threads)
+        try:
+            yield from self._run(func, image_paths, writer)
+        finally:
+            if self.opencv_threads is not None:
+                cv2.setNumThreads(previous_opencv_threads)
+
+    def _run(self, func, image_paths, writer):
+        completed = []
+        completed_ready = threading.Condition()
+
+        def run_job(image_path, cost):
+            writes = []
+            try:
+                with writer.track() if writer is not None else nullcontext(writes) as writes:
+                    outcome = (image_path, func(image_path), None)
+            except Exception as e:
+                outcome = (image_path, None, e)
+            finally:
+                self._finish()
+                self._release_after(writes, cost)
+            with completed_ready:
+                completed.append(outcome)
+                completed_ready.notify()
+
+        submitted = 0
+        yielded = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for image_path in image_paths:
+                cost = self.job_cost(image_path)
+                if cost is None:
+                    # Unknown size: reserve the whole budget so it runs alone
+                    cost = self.memory_budget_bytes or 0
+                elif self.memory_budget_bytes is not None:
+                    cost = min(cost, self.memory_budget_bytes)
+
+                self._admit(cost)
+                executor.submit(run_job, image_path, cost)
+                submitted += 1
+
+                # Hand back anything that finished while we were admitting
+                with completed_ready:
+                    ready, completed[:] = completed[:], []
+                for outcome in ready:
+                    yielded += 1
+                    yield outcome
+
+            while yielded < submitted:
+                with completed_ready:
+                    while not completed:
+                        completed_ready.wait()
+                    ready, completed[:] = completed[:], []
+                for outcome in ready:
+                    yielded += 1
+                    yield outcome
@@ -0,0 +1,181 @@
+"""
+Background output writing for building detection.
+
+Encoding the full-size numbered visualization costs about as much as the
+detection itself, so OutputWriter moves image, CSV and array writes off the compute
+thread onto a small pool, with a configurable codec, quality and an optional
+downscaled preview. flush() (or close()) blocks until everything is on disk.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# Supported visualization codecs: file extension, OpenCV quality parameter
+# and the accepted quality range
+IMAGE_CODECS = {
+    'png': ('.png', cv2.IMWRITE_PNG_COMPRESSION, 0, 9),    # quality = compression level
+    'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY, 0, 100),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY, 1, 100),
+}
+
+# Prefix of the numbered visualization file names
+IMAGE_PREFIX = "numbered_"
+
+def numbered_image_stem(filename):
+    """Output stem of an image from the name of its numbered visualization"""
+
+    return Path(filename).stem[len(IMAGE_PREFIX):]
+
+class OutputWriter:
+    """
+    Write numbered images and CSV files, optionally on background threads.
+
+    Parameters:
+    - codec: 'png', 'jpg' or 'webp'
+    - quality: PNG compression level (0-9) or JPEG/WebP quality (0-100);
+      None keeps OpenCV's default
+    - preview_max_size: If set, also write preview_<name> downscaled so its
+      longest side is at most this many pixels
+    - max_workers: Number of writer threads; 0 writes inline on the caller's thread
+    - max_pending: Maximum queued writes; further writes block so queued
+      images can't pile up in memory
+    """
+
+    def __init__(self, codec='png', quality=None, preview_max_size=None,
+                 max_workers=2, max_pending=8):
+        if codec == 'jpeg':
+            codec = 'jpg'
+        if codec not in IMAGE_CODECS:
+            raise ValueError(f"Unsupported image codec '{codec}', choose from: {', '.join(IMAGE_CODECS)}")
+
+        self.extension, quality_flag, min_quality, max_quality = IMAGE_CODECS[codec]
+        if quality is not None and not min_quality <= int(quality) <= max_quality:
+            raise ValueError(f"Image quality for {codec} must be between {min_quality} and {max_quality}, "
+                             f"got {quality}")
+
+        self.codec = codec
+        self.encode_params = [quality_flag, int(quality)] if quality is not None else []
+        self.preview_max_size = preview_max_size
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 0 else None
+        self._pending = threading.BoundedSemaphore(max(1, max_pending))
+        self._futures = []
+        self._lock = threading.Lock()
+        # Every write that failed since the writer was created
+        self.failures = []
+        self._local = threading.local()
+
+    def image_filename(self, stem):
+        """File name of the numbered visualization for an image stem"""
+
+        return f"{IMAGE_PREFIX}{stem}{self.extension}"
+
+    @contextmanager
+    def track(self):
+        """
+        Collect the futures of the writes queued by the calling thread inside
+        the with block, e.g. to keep memory accounted until they have finished.
+        Inline writes have already finished and are not collected.
+        """
+
+        tracked = []
+        self._local.tracked = tracked
+        try:
+            yield tracked
+        finally:
+            self._local.tracked = None
+
+    def write_image(self, path, image):
+        """Encode and write an image (and its preview) to path"""
+
+        self._submit(self._write_image, Path(path), image)
+
+    def write_csv(self, path, df):
+        """Write a DataFrame to path as CSV"""
+
+        self._submit(df.to_csv, Path(path), index=False)
+
+    def write_array(self, path, array):
+        """Write a NumPy array to path as .npy (readable with np.load(mmap_mode='r'))"""
+
+        self._submit(self._write_array, Path(path), array)
+
+    def _write_array(self, path, array):
+        # Write to a temporary file first so readers never map a partial array
+        temp_path = path.with_name(path.name + '.tmp')
+        with open(temp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(temp_path, path)
+
+    def _write_image(self, path, image):
+        if not cv2.imwrite(str(path), image, self.encode_params):
+            raise IOError(f"Could not write image: {path}")
+
+        if self.preview_max_size:
+            height, width = image.shape[:2]
+            scale = self.preview_max_size / max(height, width)
+            if scale < 1:
+                image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                                   interpolation=cv2.INTER_AREA)
+            preview_path = path.with_name(f"preview_{path.name}")
+            if not cv2.imwrite(str(preview_path), image, self.encode_params):
+                raise IOError(f"Could not write image: {preview_path}")
+
+    def _submit(self, func, *args, **kwargs):
+        if self._executor is None:
+            func(*args, **kwargs)
+            return
+
+        self._pending.acquire()
+        try:
+            future = self._executor.submit(func, *args, **kwargs)
+        except Exception:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+        tracked = getattr(self._local, 'tracked', None)
+        if tracked is not None:
+            tracked.append(future)
+        with self._lock:
+            self._futures.append((args[0], future))
+
+    def flush(self):
+        """
+        Wait until every queued write has finished.
+
+        Returns:
+        - List of (path, exception) tuples for writes that failed
+        """
+
+        with self._lock:
+            futures, self._futures = self._futures, []
+
+        failures = []
+        for path, future in futures:
+            error = future.exception()
+            if error is not None:
+                print(f"✗ Error writing {path}: {str(error)}")
+                failures.append((path, error))
+
+        self.failures.extend(failures)
+        return failures
+
+    def close(self):
+        """Flush all pending writes and stop the writer threads"""
+
+        failures = self.flush()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        return failures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -115,6 +115,7 @@ def run_sample_test():
             if result:
                 print(f"✓ Test successful!")
                 print(f"  Buildings detected: {result['building_count']}")
+                print(f"  Input type: {result['input_type']}")
                 print(f"  Building area: {result['total_building_area_pixels']} pixels")
                 print(f"  Output image: {result['output_image']}")
                 return True